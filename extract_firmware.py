@@ -1,8 +1,17 @@
 #!/usr/bin/env python3
 import os
 import re
+import mmap
 import argparse
-import struct
+import itertools
+import operator
+
+# An erased flash sector, used to skip padding one sector at a time
+ERASED_SECTOR = b'\xff' * 0x1000
+
+# How the header of a firmware in the dump is rewritten, by schema:
+# (bytes stripped from the start, amount subtracted from the first byte kept)
+SCHEMA_HEADER_REWRITES = {1: (4, 4)}
 
 class FirmwareDeconstructor:
     """
@@ -12,7 +21,11 @@ class FirmwareDeconstructor:
         self.dump_file = dump_file
         self.output_dir = output_dir
         self.source_parts_dir = source_parts_dir
-        self.firmware = self._read_file(dump_file)
+        # Joined once here, so output paths in the region loop are a plain concatenation
+        self._output_prefix = os.path.join(output_dir, '')
+        self._certs_prefix = os.path.join(output_dir, 'certificates', '')
+        self.firmware = self._map_file(dump_file)
+        self._mv = memoryview(self.firmware)
         self.regions = []
 
     def _read_file(self, file_path):
@@ -20,6 +33,17 @@ class FirmwareDeconstructor:
         with open(file_path, 'rb') as f:
             return f.read()
 
+    def _map_file(self, file_path):
+        """Maps a binary file read-only into memory without copying it."""
+        with open(file_path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        # Every page is touched, and the magic searches revisit the start of the
+        # dump, so fault the whole mapping in ahead of time.
+        if hasattr(mapping, 'madvise') and hasattr(mmap, 'MADV_WILLNEED'):
+            mapping.madvise(mmap.MADV_WILLNEED)
+        return mapping
+
     def deconstruct(self):
         """
         Deconstructs the firmware dump into its constituent parts.
@@ -27,13 +51,47 @@ class FirmwareDeconstructor:
         if not os.path.exists(self.output_dir):
             os.makedirs(self.output_dir)
 
-        certs_dir = os.path.join(self.output_dir, 'certificates')
+        certs_dir = self._certs_prefix
         if not os.path.exists(certs_dir):
             os.makedirs(certs_dir)
 
-        self._find_all_regions()
-        self._calculate_sizes_and_extract()
-        self._generate_config()
+        try:
+            self._find_all_regions()
+            self._calculate_sizes_and_extract()
+            self._generate_config()
+        finally:
+            self._mv.release()
+            self.firmware.close()
+
+    def _write_file(self, file_path, buffers):
+        """
+        Writes the given buffers to a file with as few system calls as possible,
+        bypassing Python's buffered IO.
+        """
+        flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0)
+        # Same mode as open(file_path, 'wb'), so the umask applies as before
+        fd = os.open(file_path, flags, 0o666)
+        remaining = []
+        try:
+            use_writev = hasattr(os, 'writev')
+            remaining = [memoryview(buffer) for buffer in buffers if len(buffer)]
+            while remaining:
+                if use_writev:
+                    written = os.writev(fd, remaining)
+                else:
+                    written = os.write(fd, remaining[0])
+
+                # Drop what was written, the kernel may stop short of the full request
+                while remaining and written >= len(remaining[0]):
+                    written -= len(remaining.pop(0))
+                if written:
+                    remaining[0] = remaining[0][written:]
+        finally:
+            # A failed write must not leave views exported from the mapped dump,
+            # or closing the mapping would fail and hide the original error
+            for view in remaining:
+                view.release()
+            os.close(fd)
 
     def _get_source_file_path(self, name):
         """Resolves the path to a source file, handling naming variations."""
@@ -53,9 +111,10 @@ class FirmwareDeconstructor:
 
         return None
 
-    def _verify_part(self, region, name, data):
+    def _verify_part(self, region, name, header, payload):
         """
-        Verifies a single extracted part against its source file.
+        Verifies a single extracted part, given as its header followed by its
+        payload, against its source file.
         """
         source_file_path = self._get_source_file_path(name)
 
@@ -69,23 +128,53 @@ class FirmwareDeconstructor:
         source_data = self._read_file(source_file_path)
 
         # For firmware, we compare against the source file with its header stripped.
+        source_start = 0
         if region.get('type') == 'firmware':
             # The source file has a 4-byte header, while the dump has an 8-byte header.
             # Both headers are stripped before comparison.
-            source_data = source_data[4:]
+            source_start = min(4, len(source_data))
+
+        # Compare in place, so neither the part nor the source file is copied
+        matches = (len(source_data) - source_start == len(header) + len(payload)
+                   and source_data.startswith(header, source_start)
+                   and source_data.startswith(payload, source_start + len(header)))
 
-        if data != source_data:
+        if not matches:
             print(f"Error: Verification failed for {name.replace(' ', '_') + '.bin'}")
             # Write both files to disk for inspection
             debug_name = name.replace(' ', '_') + '.bin'
-            with open(os.path.join(self.output_dir, debug_name + '.extracted'), 'wb') as f:
-                f.write(data)
-            with open(os.path.join(self.output_dir, debug_name + '.source'), 'wb') as f:
-                f.write(source_data)
+            self._write_file(self._output_prefix + debug_name + '.extracted', (header, payload))
+            self._write_file(self._output_prefix + debug_name + '.source', (memoryview(source_data)[source_start:],))
             exit(1)
         else:
             print(f"Verified {name.replace(' ', '_') + '.bin'}")
 
+    def _find_occurrences(self, magic):
+        """
+        Yields the offset of every occurrence of magic in the dump, in order.
+        The dump is only scanned as far as the caller consumes offsets.
+        """
+        # Bound once, the loop runs for every hit consumed
+        find = self.firmware.find
+        offset = find(magic)
+        while offset != -1:
+            yield offset
+            offset = find(magic, offset + 1)
+
+    def _find_padding(self, start, end):
+        """
+        Returns the offset at which the trailing 0xFF bytes left by erased flash
+        begin within firmware[start:end].
+        Whole erased sectors are skipped with a single comparison each, so only
+        the last partial sector is stripped byte by byte.
+        """
+        sector_size = len(ERASED_SECTOR)
+        while end - start >= sector_size and self.firmware[end - sector_size:end] == ERASED_SECTOR:
+            end -= sector_size
+
+        window_start = max(start, end - sector_size)
+        return window_start + len(self.firmware[window_start:end].rstrip(b'\xff'))
+
     def _find_all_regions(self):
         """
         Finds all known regions in the dump file.
@@ -109,11 +198,8 @@ class FirmwareDeconstructor:
             if name == 'downloader firmware':
                 occurrence = 1
 
-            offset = -1
-            for i in range(occurrence + 1):
-                offset = self.firmware.find(magic, offset + 1)
-                if offset == -1:
-                    break
+            offsets = self._find_occurrences(magic)
+            offset = next(itertools.islice(offsets, occurrence, None), -1)
 
             if offset != -1:
                 if name == 'wifi firmware':
@@ -133,85 +219,93 @@ class FirmwareDeconstructor:
             if offset == -1:
                 break
 
-            length_bytes = self.firmware[offset + 2 : offset + 4]
-            length = struct.unpack('>H', length_bytes)[0]
+            # Big-endian length, read directly so no slice or view is created
+            length = (self.firmware[offset + 2] << 8) | self.firmware[offset + 3]
             total_length = 4 + length
             self.regions.append({'name': f'certificate_{hex(offset)}', 'offset': offset, 'size': total_length, 'type': 'certificate'})
             offset += total_length
 
-        self.regions.sort(key=lambda x: x['offset'])
+        self.regions.sort(key=operator.itemgetter('offset'))
 
     def _calculate_sizes_and_extract(self):
         """
         Calculates the size of each region, trims trailing 0xFF bytes, and extracts the data.
         """
-        for i, region in enumerate(self.regions):
+        # A region without a known size runs up to the start of the next one
+        next_offsets = [region['offset'] for region in self.regions[1:]]
+        next_offsets.append(len(self.firmware))
+
+        for region, next_offset in zip(self.regions, next_offsets):
             start = region['offset']
 
             if 'size' in region:
-                size = region['size']
-                end = start + size
-            elif i + 1 < len(self.regions):
-                end = self.regions[i+1]['offset']
+                end = start + region['size']
             else:
-                end = len(self.firmware)
-
-            data = self.firmware[start:end]
-
-            if 'type' in region and region['type'] == 'firmware' and 'schema' in region and region['schema'] == 1:
-                # The firmware in the dump has an 8-byte header that needs to be stripped.
-                h = data[4]-4
-                h = bytes([h])
-                data = h + data[5:]
-
-
-            trimmed_data = data.rstrip(b'\xff')
-
-            output_data = trimmed_data
+                end = next_offset
+            end = min(end, len(self.firmware))
+
+            header = b''
+            payload_start = start
+            header_rewrite = SCHEMA_HEADER_REWRITES.get(region.get('schema'))
+            if header_rewrite is not None:
+                strip_size, adjustment = header_rewrite
+                if start + strip_size >= end:
+                    raise IndexError(f"{region['name']} at {hex(start)} is too short for its header")
+                # Drop the leading bytes of the dump's copy and rewrite the byte after them
+                header = bytes([self.firmware[start + strip_size] - adjustment])
+                payload_start = start + strip_size + 1
+
+            payload_end = self._find_padding(payload_start, end)
+            if payload_end == payload_start:
+                header = header.rstrip(b'\xff')
 
             name = region['name']
 
             filename = name.replace(' ', '_')
             if 'type' in region and region['type'] == 'certificate':
                 filename += '.der'
-                extracted_file_path = os.path.join(self.output_dir, 'certificates', filename)
+                extracted_file_path = self._certs_prefix + filename
             else:
                 filename += '.bin'
-                extracted_file_path = os.path.join(self.output_dir, filename)
+                extracted_file_path = self._output_prefix + filename
 
-            with open(extracted_file_path, 'wb') as f_out:
-                f_out.write(output_data)
+            # Write the payload straight from the mapped dump without copying it
+            with self._mv[payload_start:payload_end] as payload:
+                self._write_file(extracted_file_path, (header, payload))
 
-            self._verify_part(region, name, output_data)
+                size = len(header) + len(payload)
+                self._verify_part(region, name, header, payload)
 
-            region['size'] = len(output_data)
-            print(f"Extracted {filename} at offset {hex(start)} with size {hex(len(output_data))}")
+            region['size'] = size
+            print(f"Extracted {filename} at offset {hex(start)} with size {hex(size)}")
 
     def _generate_config(self):
         """
         Generates a new flash_image.config file based on the extracted regions.
         """
-        with open(os.path.join(self.output_dir, 'generated_flash_image.config'), 'w') as f:
-            f.write('[flash]\n')
-            f.write('size is 1M\n')
-
-            for region in self.regions:
-                f.write(f"region at {hex(region['offset'])} is [{region['name']}]\n")
-
-            f.write('\n')
-
-            for region in self.regions:
-                name = region['name']
-                f.write(f'[{name}]\n')
-                if 'type' in region:
-                    if region['type'] == 'firmware':
-                        f.write(f"type is firmware\n")
-                        f.write(f"schema is {region['schema']}\n")
-                        f.write(f"prefix is {region['prefix']}\n")
-                        f.write(f"file is {name.replace(' ', '_')}.bin\n")
-                    elif region['type'] == 'certificate':
-                        f.write('type is tls certificate\n')
-                f.write('\n')
+        lines = ['[flash]\n', 'size is 1M\n']
+
+        for region in self.regions:
+            lines.append(f"region at {hex(region['offset'])} is [{region['name']}]\n")
+
+        lines.append('\n')
+
+        for region in self.regions:
+            name = region['name']
+            lines.append(f'[{name}]\n')
+            if 'type' in region:
+                if region['type'] == 'firmware':
+                    lines.append(f"type is firmware\n")
+                    lines.append(f"schema is {region['schema']}\n")
+                    lines.append(f"prefix is {region['prefix']}\n")
+                    lines.append(f"file is {name.replace(' ', '_')}.bin\n")
+                elif region['type'] == 'certificate':
+                    lines.append('type is tls certificate\n')
+            lines.append('\n')
+
+        # Write the whole config at once instead of one call per line
+        with open(self._output_prefix + 'generated_flash_image.config', 'w') as f:
+            f.write(''.join(lines))
 
         print("\nGenerated flash_image.config")
 